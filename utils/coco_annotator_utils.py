@@ -5,43 +5,436 @@ These functions do not return a value, instead they create folders and copies of
 
 """
 
-import json
+import io
+import math
 import os
 import random as rd
+import shutil
+import sys
+import tarfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from shutil import copy
 
+__all__ = ['create_dataset_from_annotations', 'create_dataset_split', 'create_dataset_split_balanced']
 
-def create_dataset_from_annotations(json_file, output_dir):
+try:
+    import orjson as _json
+
+    def _dumps(obj):
+        return _json.dumps(obj)
+except ImportError:
+    import json as _json
+
+    def _dumps(obj):
+        return _json.dumps(obj).encode()
+_loads = _json.loads
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    from tqdm import tqdm
+except ImportError:
+    tqdm = None
+
+_HAS_CFR = hasattr(os, 'copy_file_range')
+
+# clonefile(2) creates copy-on-write clones on APFS, shutil.copyfile on macOS only uses fcopyfile
+_clonefile = None
+if sys.platform == 'darwin':
+    try:
+        import ctypes
+        _clonefile = ctypes.CDLL(None, use_errno=True).clonefile
+        _clonefile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32]
+        _clonefile.restype = ctypes.c_int
+    except (ImportError, OSError, AttributeError):
+        _clonefile = None
+
+
+def _fast_copy(src, dst):
+    """Copies src to dst, preferably inside the kernel.
+    
+    Uses os.copy_file_range where available (reflinks on btrfs/XFS), clonefile on macOS (clones
+    on APFS), otherwise shutil.copyfile which already uses sendfile/fcopyfile. Permission bits
+    are copied like shutil.copy. A clone additionally keeps the timestamps, extended attributes
+    and ACLs of src, and its owner if the process is allowed to set it.
+    
+    """
+    if _clonefile is not None and _clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0:
+        return
+    if _HAS_CFR:
+        copied = 0
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+            size = os.fstat(src_fd).st_size
+            try:
+                while copied < size:
+                    sent = os.copy_file_range(src_fd, dst_fd, size - copied)
+                    if sent == 0:
+                        # EOF, unless nothing was copied yet: some filesystems return 0
+                        # instead of an error if they don't support copy_file_range
+                        break
+                    copied += sent
+            except OSError:
+                # only fall back if nothing was written yet
+                if copied:
+                    raise
+        if copied or size == 0:
+            shutil.copymode(src, dst)
+            return
+    shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+
+
+def _progress(iterable, total):
+    """Wraps iterable in a tqdm progress bar for the image copies, if tqdm is installed."""
+    if tqdm is None:
+        return iterable
+    return tqdm(iterable, total=total, desc="Copying images", unit="img")
+
+
+_LINK_MODES = ('hardlink', 'symlink', 'copy')
+
+
+def _remove_dst(src, dst):
+    """Removes an existing dst so that it is never written through.
+    
+    A dst that is a link to src is removed, but raises shutil.SameFileError if dst is the very
+    directory entry of src, since removing it would delete the source image.
+    
+    """
+    try:
+        same_file = os.path.samefile(src, dst)
+    except FileNotFoundError:
+        same_file = False
+    if same_file and (os.path.basename(src) == os.path.basename(dst)
+                      and os.path.samefile(os.path.dirname(src) or '.', os.path.dirname(dst) or '.')):
+        raise shutil.SameFileError("{!r} and {!r} are the same file".format(src, dst))
+    try:
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+
+
+def _place(src, dst, link_mode='hardlink'):
+    """Places src at dst as a hardlink, symlink or copy.
+    
+    Links avoid copying any image data. A hardlink falls back to a copy if it can't be created,
+    e.g. if src and dst are on different filesystems or the filesystem doesn't support hardlinks,
+    unless src is missing. An existing dst is removed instead of
+    written to, since it may be a hardlink to a source image.
+    
+    """
+    if link_mode in ('hardlink', 'symlink'):
+        if link_mode == 'hardlink':
+            link = os.link
+        else:
+            link = lambda s, d: os.symlink(os.path.abspath(s), d)
+        try:
+            try:
+                link(src, dst)
+            except FileExistsError:
+                _remove_dst(src, dst)
+                link(src, dst)
+            return
+        except FileNotFoundError:
+            raise
+        except OSError:
+            if link_mode == 'symlink':
+                raise
+    elif link_mode not in _LINK_MODES:
+        raise ValueError("Unknown link_mode {}, use 'hardlink', 'symlink' or 'copy'".format(link_mode))
+    _remove_dst(src, dst)
+    _fast_copy(src, dst)
+
+
+def _pack_copy_images(imgs, dst_dir):
+    """Copies images by packing them into an in-memory tar archive and extracting it into dst_dir.
+    
+    Coalesces the per-file I/O, which helps on network filesystems, at the cost of holding
+    all images in memory at once.
+    
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tf:
+        for i in imgs:
+            tf.add(i['path'][1:], arcname=i['file_name'])
+    buf.seek(0)
+    with tarfile.open(fileobj=buf, mode='r') as tf:
+        if hasattr(tarfile, 'data_filter'):
+            tf.extractall(dst_dir, filter='data')
+        else:
+            tf.extractall(dst_dir)
+
+
+def _copy_images(splits, copy_workers=16, pack=False, link_mode='hardlink', replace=False):
+    """Copies the images of one or more splits into their folders.
+    
+    Args:
+    - splits: list of (images, dst_dir) tuples, images being a list of COCO image dicts.
+    
+    The copies of all splits are dispatched to a single thread pool since they are I/O-bound,
+    which keeps the pool busy across split boundaries. Use copy_workers=1 for a sequential copy,
+    e.g. on spinning disks where parallel access doesn't pay off. Images are placed according to
+    link_mode, see _place. With pack=True the images are always copied, through one in-memory tar
+    archive per split. Set replace when the folders may already contain the images. It only
+    matters with pack=True: existing files are then removed before the archive is extracted, since
+    extracting would write through a hardlink to a source image. _place already replaces existing
+    files without writing through them.
+    
+    """
+    if pack:
+        for imgs, dst_dir in splits:
+            if replace:
+                for i in imgs:
+                    dst = dst_dir + i['file_name']
+                    if os.path.lexists(dst):
+                        os.remove(dst)
+            _pack_copy_images(imgs, dst_dir)
+        return
+
+    work = [(i['path'][1:], dst_dir + i['file_name']) for imgs, dst_dir in splits for i in imgs]
+
+    def _cp(item):
+        _place(item[0], item[1], link_mode)
+
+    if copy_workers <= 1:
+        for item in _progress(work, len(work)):
+            _cp(item)
+        return
+    with ThreadPoolExecutor(max_workers=copy_workers) as ex:
+        for _ in _progress(ex.map(_cp, work), len(work)):
+            pass
+
+
+def _shuffle(images):
+    """Returns a shuffled copy of a list of images.
+    
+    Uses a vectorized numpy permutation if numpy is installed. The numpy generator is seeded
+    from the random module, so random.seed() keeps making splits reproducible.
+    
+    """
+    if np is None:
+        return rd.sample(images, len(images))
+    perm = np.random.default_rng(rd.getrandbits(64)).permutation(len(images))
+    images_arr = np.empty(len(images), dtype=object)
+    images_arr[:] = images
+    return images_arr[perm].tolist()
+
+
+def _pick_test_images(indptr, cats, limit, n_cats):
+    """Greedily picks test images until a category reaches limit, compiled with numba.
+    
+    Args:
+    - indptr: CSR offsets, the categories of image i are cats[indptr[i]:indptr[i+1]].
+    - cats: category indices of all annotations in image order.
+    - limit: an image is skipped if one of its categories has been picked limit times.
+    - n_cats: number of categories.
+    
+    """
+    count = np.zeros(n_cats, np.int64)
+    pick = np.zeros(len(indptr) - 1, np.bool_)
+    for i in range(len(indptr) - 1):
+        s, e = indptr[i], indptr[i + 1]
+        if s == e:
+            continue
+        full = False
+        for k in range(s, e):
+            if count[cats[k]] == limit:
+                full = True
+                break
+        if full:
+            continue
+        for k in range(s, e):
+            count[cats[k]] += 1
+        pick[i] = True
+    return pick
+
+
+if njit is not None:
+    _pick_test_images = njit(cache=True)(_pick_test_images)
+
+
+def _select_test_images_jit(shuffled_imgs, anno_by_img, cat_ids, limit):
+    """Splits images into test images and images without annotations using _pick_test_images.
+    
+    Same selection as the loop in create_dataset_split_balanced, on CSR arrays of the categories.
+    
+    """
+    cat_index = {cat_id: k for k, cat_id in enumerate(cat_ids)}
+    num_annos = np.fromiter((len(anno_by_img.get(img['id'], ())) for img in shuffled_imgs),
+                            dtype=np.int64, count=len(shuffled_imgs))
+    indptr = np.zeros(len(shuffled_imgs) + 1, dtype=np.int64)
+    np.cumsum(num_annos, out=indptr[1:])
+    cats = np.fromiter((cat_index[ann['category_id']] for img in shuffled_imgs
+                        for ann in anno_by_img.get(img['id'], ())),
+                       dtype=np.int64, count=int(indptr[-1]))
+    pick = _pick_test_images(indptr, cats, limit, len(cat_ids))
+    # boolean indexing builds the result lists at their final size
+    imgs_arr = np.empty(len(shuffled_imgs), dtype=object)
+    imgs_arr[:] = shuffled_imgs
+    return imgs_arr[pick].tolist(), imgs_arr[num_annos == 0].tolist()
+
+
+class _StreamedArray:
+    """Re-iterable view on a top level array of a json file.
+    
+    Every iteration parses the file incrementally with ijson, so only one element is held in memory.
+    
+    """
+    def __init__(self, json_file, key):
+        self.json_file = json_file
+        self.key = key
+
+    def __iter__(self):
+        with open(self.json_file, 'rb') as json_f:
+            yield from ijson.items(json_f, self.key + '.item', use_float=True)
+
+
+def _load_arrays(json_file, keys):
+    """Loads the given top level arrays of a json file in a single ijson pass.
+    
+    Other keys, e.g. the annotations, are only tokenized and never built into objects. Parsing
+    stops as soon as all requested arrays have been read.
+    
+    """
+    arrays = {key: [] for key in keys}
+    item_prefixes = {key + '.item': arrays[key] for key in keys}
+    remaining = set(keys)
+    builder = items = item_prefix = None
+    with open(json_file, 'rb') as json_f:
+        for prefix, event, value in ijson.parse(json_f, use_float=True):
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == item_prefix and event in ('end_map', 'end_array'):
+                    items.append(builder.value)
+                    builder = None
+            elif prefix in item_prefixes:
+                item_prefix, items = prefix, item_prefixes[prefix]
+                if event in ('start_map', 'start_array'):
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                else:
+                    items.append(value)
+            elif event == 'end_array' and prefix in remaining:
+                remaining.discard(prefix)
+                if not remaining:
+                    break
+    return arrays
+
+
+def _load_coco(json_file, keys=('images', 'annotations', 'categories')):
+    """Loads the given top level arrays of a COCO json file, returned as a tuple in order of keys.
+    
+    If ijson is installed, all arrays except the annotations are read in a single pass and the
+    annotations are streamed from the file whenever they are iterated instead of being loaded
+    into memory. Otherwise the whole file is parsed at once.
+    
+    """
+    if ijson is None:
+        with open(json_file, 'rb') as json_f:
+            data = _loads(json_f.read())
+        return tuple(data[key] for key in keys)
+    arrays = _load_arrays(json_file, [key for key in keys if key != 'annotations'])
+    arrays['annotations'] = _StreamedArray(json_file, 'annotations')
+    return tuple(arrays[key] for key in keys)
+
+
+def _stream_dump_splits(outputs, annotations, split_of, categories, category_id=None):
+    """Writes one COCO json file per split in a single pass over the annotations.
+    
+    Annotations are serialized one at a time, so together with streamed annotations no split's
+    annotations are ever held in memory.
+    
+    Args:
+    - outputs: dict mapping split keys to (path, images) tuples.
+    - annotations: iterable of COCO annotation dicts.
+    - split_of: dict mapping image ids to a split key.
+    - categories: list of COCO category dicts, written to every file.
+    - category_id: if set, overrides the category of every written annotation.
+    
+    """
+    with ExitStack() as stack:
+        files = {}
+        for split, (path, images) in outputs.items():
+            fp = stack.enter_context(open(path, 'wb'))
+            fp.write(b'{"images":')
+            fp.write(_dumps(images))
+            fp.write(b',"annotations":[')
+            files[split] = fp
+        empty = set(files)
+        for anno in annotations:
+            split = split_of.get(anno['image_id'])
+            fp = files.get(split)
+            if fp is None:
+                continue
+            if category_id is not None:
+                anno['category_id'] = category_id
+            if split in empty:
+                empty.discard(split)
+            else:
+                fp.write(b',')
+            fp.write(_dumps(anno))
+        categories_json = _dumps(categories)
+        for fp in files.values():
+            fp.write(b'],"categories":')
+            fp.write(categories_json)
+            fp.write(b'}')
+
+
+def create_dataset_from_annotations(json_file, output_dir, copy_workers=16, pack=False,
+                                    link_mode='hardlink', overwrite=False):
     """Creates a dataset by copying only images with existing annotations.
     
     Args:
     - json_file: json data in form of COCO-Dataset format (http://cocodataset.org/#home).
     - output_dir: folder that will include the copies of all images and the json file.
+    - copy_workers: number of threads used to copy images, 1 copies sequentially.
+    - pack: copy images through an in-memory tar archive, trades memory for fewer file operations.
+    - link_mode: 'hardlink', 'symlink' or 'copy', how images are placed in the output folder.
+                 Hardlinks fall back to copies across filesystems. Ignored if pack is set.
+    - overwrite: write into output_dir even if it already exists, images of a previous run are removed.
     
     """
     # check json file existence
-    assert (os.path.isfile(json_file)),"JSON file doesn't exist!"
+    if not os.path.isfile(json_file):
+        raise FileNotFoundError("JSON file {} doesn't exist!".format(json_file))
+    if link_mode not in _LINK_MODES:
+        raise ValueError("Unknown link_mode {}, use 'hardlink', 'symlink' or 'copy'".format(link_mode))
+    images_dir = output_dir + 'images/'
     # create output directory if not exists
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
-        os.mkdir("%simages" % output_dir)
-        print("Directory " , output_dir ,  " Created ")
-        print("Directory " , "%simages" % output_dir ,  " Created ")
-    else:
+    exists = os.path.exists(output_dir)
+    if exists and not overwrite:
         print("Output folder already exists, please rename or choose a different name!")
         return
+    if exists:
+        # clear images of a previous run
+        shutil.rmtree(images_dir, ignore_errors=True)
+    os.makedirs(images_dir, exist_ok=True)
+    print("Directory " , images_dir ,  " Created ")
 
-    with open(json_file) as json_f:
-        data = json.load(json_f)
-        for i in data['images']:
-            src = i['path'][1:]
-            dst = output_dir + 'images/' + i['file_name']
-            copy(src,dst)
+    images, = _load_coco(json_file, ('images',))
+    _copy_images([(images, images_dir)], copy_workers, pack, link_mode)
             
     copy(json_file, output_dir)
 
 
-def create_dataset_split(json_file, output_dir, split=[0.7,0.15,0.15], supercategory=[False,""]):
+def create_dataset_split(json_file, output_dir, split=[0.7,0.15,0.15], supercategory=[False,""],
+                         copy_workers=16, pack=False, link_mode='hardlink', overwrite=False):
     """Splits a dataset into up to three sets.
     
     Args:
@@ -51,132 +444,117 @@ def create_dataset_split(json_file, output_dir, split=[0.7,0.15,0.15], supercate
              and third test set. Must sum up to 1.
     - supercategory: list of [Boolean, String], that defines if all categories should be combined to
                      a single supercategory. Turned off by default.
+    - copy_workers: number of threads used to copy images, 1 copies sequentially.
+    - pack: copy images through an in-memory tar archive, trades memory for fewer file operations.
+    - link_mode: 'hardlink', 'symlink' or 'copy', how images are placed in the output folder.
+                 Hardlinks fall back to copies across filesystems. Ignored if pack is set.
+    - overwrite: write into output_dir even if it already exists, images of a previous run are removed.
                      
     
     """
     # check json file existence
-    assert (os.path.isfile(json_file)),"JSON file doesn't exist!"
+    if not os.path.isfile(json_file):
+        raise FileNotFoundError("JSON file {} doesn't exist!".format(json_file))
+    if link_mode not in _LINK_MODES:
+        raise ValueError("Unknown link_mode {}, use 'hardlink', 'symlink' or 'copy'".format(link_mode))
     # check if split is reasonable and sums to 1
-    assert (sum(split) == 1),"Incorrect Split, please make [train,val,test] sum to 1"
+    if not math.isclose(sum(split), 1.0, abs_tol=1e-9):
+        raise ValueError("Incorrect Split, please make [train,val,test] sum to 1")
+    train_dir = output_dir + "training/"
+    val_dir = output_dir + "validation/"
+    test_dir = output_dir + "test/"
     # create output directory if not exists
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
-        os.mkdir("%straining" % output_dir)
-        os.mkdir("%svalidation" % output_dir)
-        os.mkdir("%stest" % output_dir)
-        print("Directory " , output_dir ,  " Created ")
-        print("Directory " , "%straining" % output_dir ,  " Created ")
-        print("Directory " , "%svalidation" % output_dir ,  " Created ")
-        print("Directory " , "%stest" % output_dir ,  " Created ")
-    else:
+    exists = os.path.exists(output_dir)
+    if exists and not overwrite:
         print("Output folder already exists, please rename or choose a different name!")
         return
+    for sub_dir in (train_dir, val_dir, test_dir):
+        if exists:
+            # clear images of a previous run, they would leak into other splits
+            shutil.rmtree(sub_dir, ignore_errors=True)
+        os.makedirs(sub_dir, exist_ok=True)
+        print("Directory " , sub_dir ,  " Created ")
     
     # load annotation data from json
-    with open(json_file) as json_data:
-        data = json.load(json_data)
-        # determine amount of images according to split
-        num_images = len(data['images'])
-        print("{} images found!".format(num_images))
-        num_train = int(num_images * split[0])
-        num_val = int(num_images * split[1])
-        num_test = num_images - num_train - num_val
-        print("{} Training, {} Validation, {} Test - Images".format(num_train, num_val, num_test))
-        # create image split from shuffled data
-        shuffled_imgs = rd.sample(data['images'], num_images)
-        imgs_train = shuffled_imgs[:num_train]
-        img_ids_train = [img['id'] for img in imgs_train]
-        imgs_val = shuffled_imgs[num_train:num_train+num_val]
-        img_ids_val = [img['id'] for img in imgs_val]
-        imgs_test = shuffled_imgs[num_train+num_val:num_images]
-        img_ids_test = [img['id'] for img in imgs_test]
-        
-        if supercategory[0]==True:
-            single_label = supercategory[1]
-            categ_all = [{"id": 1, "name": single_label, "supercategory": "", "color": "#df3ccd", "metadata": {}}]
-            # update all annotations to one category
-            for anno in data['annotations']:
-                anno['category_id'] = 1
-        else:
-            # categories will stay the same for all splits
-            categ_all = data['categories']
-        
-        anno_train = [anno for anno in data['annotations'] if anno['image_id'] in img_ids_train]
-        anno_val = [anno for anno in data['annotations'] if anno['image_id'] in img_ids_val]
-        anno_test = [anno for anno in data['annotations'] if anno['image_id'] in img_ids_test]
-
-        # create json dicts
-        train_dict = {
-            #"info": {...},
-            #"licenses": [...],
-            "images": imgs_train,
-            "annotations": anno_train,
-            "categories": categ_all
-            #"segment_info": [...] <-- Only in Panoptic annotations
-        }
-        val_dict = {
-            "images": imgs_val,
-            "annotations": anno_val,
-            "categories": categ_all
-        }
-        test_dict = {
-            "images": imgs_test,
-            "annotations": anno_test,
-            "categories": categ_all
-        }
-        
-        # write json files
-        with open('{}training.json'.format(output_dir), 'w') as fp:
-            json.dump(train_dict, fp)
-        with open('{}validation.json'.format(output_dir), 'w') as fp:
-            json.dump(val_dict, fp)
-        with open('{}test.json'.format(output_dir), 'w') as fp:
-            json.dump(test_dict, fp)
+    images, annotations, categories = _load_coco(json_file)
+    # determine amount of images according to split
+    num_images = len(images)
+    print("{} images found!".format(num_images))
+    num_train = int(num_images * split[0])
+    num_val = int(num_images * split[1])
+    num_test = num_images - num_train - num_val
+    print("{} Training, {} Validation, {} Test - Images".format(num_train, num_val, num_test))
+    # create image split from shuffled data
+    shuffled_imgs = _shuffle(images)
+    imgs_train = shuffled_imgs[:num_train]
+    imgs_val = shuffled_imgs[num_train:num_train+num_val]
+    imgs_test = shuffled_imgs[num_train+num_val:num_images]
+    
+    if supercategory[0]==True:
+        single_label = supercategory[1]
+        categ_all = [{"id": 1, "name": single_label, "supercategory": "", "color": "#df3ccd", "metadata": {}}]
+    else:
+        # categories will stay the same for all splits
+        categ_all = categories
+    
+    # index image ids by split to look up the split of each annotation
+    split_of = {img['id']: 'tr' for img in imgs_train}
+    split_of.update((img['id'], 'va') for img in imgs_val)
+    split_of.update((img['id'], 'te') for img in imgs_test)
+    # update all annotations to one category if requested
+    category_id = 1 if supercategory[0]==True else None
+    
+    # write json files in the background while the images are copied, one file per split
+    # ("info", "licenses" and "segment_info" are not written)
+    outputs = {'tr': ('{}training.json'.format(output_dir), imgs_train),
+               'va': ('{}validation.json'.format(output_dir), imgs_val),
+               'te': ('{}test.json'.format(output_dir), imgs_test)}
+    with ThreadPoolExecutor(max_workers=1) as json_writer:
+        json_future = json_writer.submit(_stream_dump_splits, outputs, annotations, split_of,
+                                         categ_all, category_id)
         
         # copy images to respective folders
-        for i in imgs_train:
-            src = i['path'][1:]
-            dst = output_dir + "training/" + i['file_name']
-            copy(src,dst)
-        for i in imgs_val:
-            src = i['path'][1:]
-            dst = output_dir + "validation/" + i['file_name']
-            copy(src,dst)
-        for i in imgs_test:
-            src = i['path'][1:]
-            dst = output_dir + "test/" + i['file_name']
-            copy(src,dst)
-
-
-def create_dataset_split_balanced(json_file, output_dir, num_testimages_per_class=7):
+        splits = [(imgs_train, train_dir), (imgs_val, val_dir), (imgs_test, test_dir)]
+        _copy_images(splits, copy_workers, pack, link_mode)
+        json_future.result()
+
+
+def create_dataset_split_balanced(json_file, output_dir, num_testimages_per_class=7, copy_workers=16,
+                                  pack=False, link_mode='hardlink'):
     # check json file existence
-    assert (os.path.isfile(json_file)),"JSON file doesn't exist!"
+    if not os.path.isfile(json_file):
+        raise FileNotFoundError("JSON file {} doesn't exist!".format(json_file))
+    if link_mode not in _LINK_MODES:
+        raise ValueError("Unknown link_mode {}, use 'hardlink', 'symlink' or 'copy'".format(link_mode))
     # create output directory if not exists
     # in this method we don't care about validation
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
-        os.mkdir("%straining" % output_dir)
-        # os.mkdir("%svalidation" % output_dir)
-        os.mkdir("%stest" % output_dir)
-        print("Directory " , output_dir ,  " Created ")
-        print("Directory " , "%straining" % output_dir ,  " Created ")
-        # print("Directory " , "%svalidation" % output_dir ,  " Created ")
-        print("Directory " , "%stest" % output_dir ,  " Created ")
-    else:
+    train_dir = output_dir + "training/"
+    test_dir = output_dir + "test/"
+    exists = os.path.exists(output_dir)
+    if exists:
         print("Output folder already exists, please rename or choose a different name!")
-        # return
+    for sub_dir in (train_dir, test_dir):
+        os.makedirs(sub_dir, exist_ok=True)
+        print("Directory " , sub_dir ,  " Created ")
     
     # load annotation data from json
-    with open(json_file) as json_data:
-        data = json.load(json_data)
-        num_images = len(data['images'])
-        print("{} images found!".format(num_images))
-        
-        # shuffle images
-        shuffled_imgs = rd.sample(data['images'], num_images)
-        cat_ids = [cat['id'] for cat in data['categories']]
-        print("all category ids {}".format(cat_ids))
-        
+    images, annotations, categories = _load_coco(json_file)
+    num_images = len(images)
+    print("{} images found!".format(num_images))
+    
+    # shuffle images
+    shuffled_imgs = _shuffle(images)
+    cat_ids = [cat['id'] for cat in categories]
+    print("all category ids {}".format(cat_ids))
+    
+    # index annotations by image once instead of scanning all annotations per image
+    anno_by_img = defaultdict(list)
+    for anno in annotations:
+        anno_by_img[anno['image_id']].append(anno)
+    
+    if njit is not None:
+        imgs_test, imgs_without_anno = _select_test_images_jit(shuffled_imgs, anno_by_img, cat_ids, 7)
+    else:
         cat_count = {id:0 for id in cat_ids}
         imgs_without_anno = []
         imgs_test = []
@@ -186,8 +564,8 @@ def create_dataset_split_balanced(json_file, output_dir, num_testimages_per_clas
 #             if all(value == num_testimages_per_class for value in cat_count.values()):
 #                 print("test category counts by id {}".format(cat_count))
 #                 break
-            annotations = [anno for anno in data['annotations'] if anno['image_id'] == img['id']]
-            cats = [ann['category_id'] for ann in annotations]
+            img_annos = anno_by_img.get(img['id'], ())
+            cats = [ann['category_id'] for ann in img_annos]
             if any(cat_count[cat] == 7 for cat in cats):
                 continue
             # only append images that have annotations
@@ -197,51 +575,32 @@ def create_dataset_split_balanced(json_file, output_dir, num_testimages_per_clas
                 imgs_test.append(img)
             else:
                 imgs_without_anno.append(img)
+    
+    
+    ids_not_train = {img['id'] for img in imgs_test}
+    ids_not_train.update(img['id'] for img in imgs_without_anno)
+    imgs_train = [x for x in shuffled_imgs if x['id'] not in ids_not_train]
+    print("Training images: {}".format(len(imgs_train)))
+    print("Test images: {}".format(len(imgs_test)))
+    print("Empty images: {}".format(len(imgs_without_anno)))
+    
+    categ_all = categories
+    # TODO add Instrument as Supercategory of all
+    
+    split_of = {img['id']: 'tr' for img in imgs_train}
+    split_of.update((img['id'], 'te') for img in imgs_test)
+    
+    # write json files in the background while the images are copied, one file per split,
+    # reusing the annotations already indexed in memory
+    outputs = {'tr': ('{}training.json'.format(output_dir), imgs_train),
+               'te': ('{}test.json'.format(output_dir), imgs_test)}
+    indexed_annos = (anno for img_annos in anno_by_img.values() for anno in img_annos)
+    with ThreadPoolExecutor(max_workers=1) as json_writer:
+        json_future = json_writer.submit(_stream_dump_splits, outputs, indexed_annos, split_of, categ_all)
         
-        imgs_temp = [x for x in shuffled_imgs if x not in imgs_test]
-        imgs_train = [x for x in imgs_temp if x not in imgs_without_anno]
-        print("Training images: {}".format(len(imgs_train)))
-        print("Test images: {}".format(len(imgs_test)))
-        print("Empty images: {}".format(len(imgs_without_anno)))
-        
-        img_ids_train = [img['id'] for img in imgs_train]
-        img_ids_test = [img['id'] for img in imgs_test]
-        
-        categ_all = data['categories']
-        # TODO add Instrument as Supercategory of all
-        
-        anno_train = [anno for anno in data['annotations'] if anno['image_id'] in img_ids_train]
-        anno_test = [anno for anno in data['annotations'] if anno['image_id'] in img_ids_test]
-
-        # create json dicts
-        train_dict = {
-            #"info": {...},
-            #"licenses": [...],
-            "images": imgs_train,
-            "annotations": anno_train,
-            "categories": categ_all
-            #"segment_info": [...] <-- Only in Panoptic annotations
-        }
-        test_dict = {
-            "images": imgs_test,
-            "annotations": anno_test,
-            "categories": categ_all
-        }
+        # copy images to respective folders
+        splits = [(imgs_train, train_dir), (imgs_test, test_dir)]
+        _copy_images(splits, copy_workers, pack, link_mode, replace=exists)
+        json_future.result()
         
-        # write json files
-        with open('{}training.json'.format(output_dir), 'w') as fp:
-            json.dump(train_dict, fp)
-        with open('{}test.json'.format(output_dir), 'w') as fp:
-            json.dump(test_dict, fp)
         
-        # copy images to respective folders
-        for i in imgs_train:
-            src = i['path'][1:]
-            dst = output_dir + "training/" + i['file_name']
-            copy(src,dst)
-        for i in imgs_test:
-            src = i['path'][1:]
-            dst = output_dir + "test/" + i['file_name']
-            copy(src,dst)
-            
-            